@@ -13,17 +13,30 @@ import asyncio
 
 from dutctl import dutctl
 
+# Use the faster libuv-based event loop where available
+try:
+    import uvloop
+except ImportError:
+    uvloop = None  # pylint: disable=invalid-name
 
-def term(sig: int = 0, frame=None):     # pylint: disable=unused-argument
+
+def term(sig: int = 0):
     print(f'\nINFO: terminating due to caught signal {sig}')
     dutctl.end_event.set()
 
 
+async def run(args: list) -> int:
+    # Create end event on running loop, then register termination handlers.
+    # Handlers registered with the loop wake it up, which plain signal handlers would not.
+    dutctl.end_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGQUIT, signal.SIGABRT):
+        loop.add_signal_handler(sig, term, sig)
+    return await dutctl.main(args)
+
+
 if __name__ == '__main__':
-    # Register termination handlers
-    signal.signal(signal.SIGTERM, term)
-    signal.signal(signal.SIGINT, term)
-    signal.signal(signal.SIGQUIT, term)
-    signal.signal(signal.SIGABRT, term)
     # Launch main
-    sys.exit(asyncio.run(dutctl.main(sys.argv[1:])))
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    sys.exit(asyncio.run(run(sys.argv[1:])))
@@ -7,11 +7,13 @@
 
 # Functions to control and read out Agilent instruments.
 
+import re
 import time
 import sys
-import hashlib
+import asyncio
 from dataclasses import dataclass, field
 import yaml
+import xxhash
 import pyvisa as vs
 
 Instr = vs.resources.tcpip.TCPIPInstrument
@@ -20,6 +22,13 @@ Instr = vs.resources.tcpip.TCPIPInstrument
 # Hash to bypass config checking. USE AT YOUR OWN RISK.
 CFG_BYPASS_HASH = 0xd0a515a1
 HASH_MISMATCH_CODE = 17
+SAFETY_HASH_LINE_RE = re.compile(rb'^safety_hash:.*(?:\r?\n|$)', re.MULTILINE)
+
+# Use the C YAML loader where available
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Instruments (by resource name) found to reject channel lists in measurement queries
+NO_CHANLIST_INSTRS = set()
 
 
 @dataclass
@@ -73,99 +82,179 @@ def reset_instr(instr: Instr):
     instr.write('*RST')
 
 
+# Join SCPI commands into one message. The leading colon makes each path absolute.
+def join_cmds(cmds) -> str:
+    return ';:'.join(cmds)
+
+
 # =========================
 #    PSU Channel Methods
 # =========================
 
+def pch_vol_cur_cmd(
+        vol: float, cur: float, volmin: float, volmax: float, channel: int = 0) -> str:
+    assert volmin <= vol <= volmax
+    return f'APPLY {vol}, {cur}' if channel == 0 else f'APPLY CH{channel}, {vol}, {cur}'
+
+
+def pch_fourwire_cmd(fourwire: bool = True, channel: int = 0) -> str:
+    channel = 1 if channel == 0 else channel
+    return f'VOLTAGE:SENSE:SOURCE {"EXTERNAL" if fourwire else "INTERNAL"}, (@{channel})'
+
+
+def pch_active_cmd(active: bool = True, channel: int = 0) -> str:
+    channel = 1 if channel == 0 else channel
+    return f'OUTPUT:state {"ON" if active else "OFF"},(@{channel})'
+
+
 def set_pch_vol_cur(
         instr: Instr, vol: float, cur: float,
-        volmin: float, volmax: float, channel: int = 0):
-    assert volmin <= vol <= volmax
-    if channel == 0:
-        instr.write(f'APPLY {vol}, {cur}')
+        volmin: float, volmax: float, channel: int = 0, wait_opc: bool = False):
+    cmd = pch_vol_cur_cmd(vol, cur, volmin, volmax, channel)
+    # If requested, block until the instrument completed the command
+    if wait_opc:
+        instr.query(f'{cmd};*OPC?')
     else:
-        instr.write(f'APPLY CH{channel}, {vol}, {cur}')
-    time.sleep(0.05)    # wait until voltage is really set
+        instr.write(cmd)
 
 
 def set_pch_fourwire(instr, fourwire: bool = True, channel: int = 0):
-    channel = 1 if channel == 0 else channel
-    instr.write(f'VOLTAGE:SENSE:SOURCE {"EXTERNAL" if fourwire else "INTERNAL"}, (@{channel})')
+    instr.write(pch_fourwire_cmd(fourwire, channel))
 
 
 def set_pch_active(instr: Instr, active: bool = True, channel: int = 0):
-    channel = 1 if channel == 0 else channel
-    instr.write(f'OUTPUT:state {"ON" if active else "OFF"},(@{channel})')
+    instr.write(pch_active_cmd(active, channel))
 
 
-def meas_pch_vol_or_cur(instr: Instr, tpe: str = 'VOLT', channel: int = 0) -> float:
+# Build measurement query for one or more channels
+def meas_query(tpe: str, channels: list) -> str:
     assert tpe.startswith('VOLT') or tpe.startswith('CURR')
-    channel = 1 if channel == 0 else channel
-    return float(instr.query(f'MEASURE:SCALAR:{tpe}:DC? (@{channel})'))
+    chanlist = ','.join(str(1 if channel == 0 else channel) for channel in channels)
+    return f'MEASURE:SCALAR:{tpe}:DC? (@{chanlist})'
+
+
+# Parse measurement response for the given number of channels
+def meas_response(resp: str, num_channels: int) -> list:
+    vals = resp.split(',')
+    if len(vals) != num_channels:
+        raise ValueError(f'expected {num_channels} values, got {len(vals)}')
+    return [float(val) for val in vals]
+
+
+def meas_pch_vol_or_cur(instr: Instr, tpe: str = 'VOLT', channel: int = 0) -> float:
+    return float(instr.query(meas_query(tpe, [channel])))
+
+
+# Measure multiple channels with one query using a channel list
+def meas_pchs_vol_or_cur(instr: Instr, tpe: str = 'VOLT', channels: list = (0,)) -> list:
+    return meas_response(instr.query(meas_query(tpe, channels)), len(channels))
 
 
 # =================
 #    PSU Methods
 # =================
 
-def set_psu_opmode(instr: Instr, opmode: str = 'OFF'):
+def psu_opmode_cmd(opmode: str = 'OFF') -> str:
     assert opmode in ('OFF', 'PAR', 'SER')
-    instr.write(f'OUTPUT:PAIR {opmode}')
+    return f'OUTPUT:PAIR {opmode}'
 
 
-def set_psu_gpio_state(instr: Instr, pin: int = 1, val: bool = True):
+def set_psu_opmode(instr: Instr, opmode: str = 'OFF'):
+    instr.write(psu_opmode_cmd(opmode))
+
+
+def psu_gpio_state_cmd(pin: int = 1, val: bool = True) -> str:
     assert pin > 0
-    instr.write(f'DIGITAL:PIN{pin}:FUNCTION DIO')
-    instr.write(f'DIGITAL:PIN{pin}:POLARITY POSITIVE')
-    instr.write(f'DIGITAL:OUTPUT:DATA {int(val)}')
+    return join_cmds([
+        f'DIGITAL:PIN{pin}:FUNCTION DIO',
+        f'DIGITAL:PIN{pin}:POLARITY POSITIVE',
+        f'DIGITAL:OUTPUT:DATA {int(val)}'])
+
+
+def set_psu_gpio_state(instr: Instr, pin: int = 1, val: bool = True):
+    instr.write(psu_gpio_state_cmd(pin, val))
+
+
+# Return one command setting up all channels and one toggling their outputs (if desired)
+def psu_channel_configs_cmds(channel_configs: dict, toggle_output_state: bool = True) -> (str, str):
+    set_cmd = join_cmds(
+        cmd for chan, cfg in channel_configs.items() for cmd in (
+            pch_vol_cur_cmd(cfg.vol, cfg.cur, cfg.volmin, cfg.volmax, chan),
+            pch_fourwire_cmd(cfg.fourwire, chan)))
+    active_cmd = None
+    if toggle_output_state:
+        active_cmd = join_cmds(
+            pch_active_cmd(cfg.active, chan) for chan, cfg in channel_configs.items())
+    return set_cmd, active_cmd
 
 
 def set_psu_channel_configs(instr: Instr, channel_configs: dict, toggle_output_state: bool = True):
-    for chan, cfg in channel_configs.items():
-        set_pch_vol_cur(instr, cfg.vol, cfg.cur, cfg.volmin, cfg.volmax, chan)
-        set_pch_fourwire(instr, cfg.fourwire, chan)
-        if toggle_output_state:
-            set_pch_active(instr, cfg.active, chan)
+    if not channel_configs:
+        return
+    set_cmd, active_cmd = psu_channel_configs_cmds(channel_configs, toggle_output_state)
+    # Set all channels and wait until done in one round trip before toggling any outputs
+    instr.query(f'{set_cmd};*OPC?')
+    if active_cmd is not None:
+        instr.write(active_cmd)
 
 
 # ===========================
 #    Siggen Source Methods
 # ===========================
 
-def set_sigsrc_freq(instr: Instr, freq: float, source: int = 1):
+def sigsrc_freq_cmd(freq: float, source: int = 1) -> str:
     assert source > 0
-    instr.write(f'SOURCE{source}:FREQ {freq}')
+    return f'SOURCE{source}:FREQ {freq}'
 
 
-def set_sigsrc_levels(instr: Instr, vhi: float, vlo: float, source: int = 1):
+def sigsrc_levels_cmd(vhi: float, vlo: float, source: int = 1) -> str:
     assert source > 0
-    instr.write(f'SOURCE{source}:VOLT:HIGH {vhi}')
-    instr.write(f'SOURCE{source}:VOLT:LOW {vlo}')
+    return join_cmds([f'SOURCE{source}:VOLT:HIGH {vhi}', f'SOURCE{source}:VOLT:LOW {vlo}'])
 
 
-def set_sigsrc_shape(instr: Instr, shape: str, duty: float, source: int = 1):
+def sigsrc_shape_cmd(shape: str, duty: float, source: int = 1) -> str:
     assert shape in ('SQU', 'SIN', 'TRI', 'RAMP', 'NRAN')
     assert 0 < duty < 100
-    instr.write(f'SOURCE{source}:FUNC {shape}')
-    instr.write(f'SOURCE{source}:FUNC:{shape}:DCYC {duty}')
+    return join_cmds([f'SOURCE{source}:FUNC {shape}', f'SOURCE{source}:FUNC:{shape}:DCYC {duty}'])
 
 
-def set_sigsrc_active(instr: Instr, active: bool, source: int = 1):
+def sigsrc_active_cmd(active: bool, source: int = 1) -> str:
     assert source > 0
-    instr.write(f'OUTPUT{source} {"ON" if active else "OFF"}')
+    return f'OUTPUT{source} {"ON" if active else "OFF"}'
+
+
+def set_sigsrc_freq(instr: Instr, freq: float, source: int = 1):
+    instr.write(sigsrc_freq_cmd(freq, source))
+
+
+def set_sigsrc_levels(instr: Instr, vhi: float, vlo: float, source: int = 1):
+    instr.write(sigsrc_levels_cmd(vhi, vlo, source))
+
+
+def set_sigsrc_shape(instr: Instr, shape: str, duty: float, source: int = 1):
+    instr.write(sigsrc_shape_cmd(shape, duty, source))
+
+
+def set_sigsrc_active(instr: Instr, active: bool, source: int = 1):
+    instr.write(sigsrc_active_cmd(active, source))
 
 
 # ====================
 #    Siggen Methods
 # ====================
 
+# Sets up all sources in one write
 def set_siggen_source_configs(instr: Instr, source_configs: dict, toggle_output_state: bool = True):
+    cmds = []
     for src, cfg in source_configs.items():
-        set_sigsrc_freq(instr, cfg.freq, src)
-        set_sigsrc_levels(instr, cfg.vhi, cfg.vlo, src)
-        set_sigsrc_shape(instr, cfg.shape, cfg.duty, src)
+        cmds += [
+            sigsrc_freq_cmd(cfg.freq, src),
+            sigsrc_levels_cmd(cfg.vhi, cfg.vlo, src),
+            sigsrc_shape_cmd(cfg.shape, cfg.duty, src)]
         if toggle_output_state:
-            set_sigsrc_active(instr, cfg.active, src)
+            cmds.append(sigsrc_active_cmd(cfg.active, src))
+    if cmds:
+        instr.write(join_cmds(cmds))
 
 
 # ==========================
@@ -175,12 +264,13 @@ def set_siggen_source_configs(instr: Instr, source_configs: dict, toggle_output_
 # Return instrument config from YML file
 def config_from_yml(yaml_file: str) -> (dict, bool):
     # Load file
-    with open(yaml_file, 'r', encoding='utf-8') as file:
-        cfg = yaml.safe_load(file)
-    # Check hash
+    with open(yaml_file, 'rb') as file:
+        raw = file.read()
+    cfg = yaml.load(raw, Loader=YamlLoader)
+    # Check hash of raw file without hash line. This is a safety check, not security.
     given_hash = int(cfg['safety_hash'])
     del cfg['safety_hash']
-    actual_hash = int(hashlib.md5(str(cfg).encode('utf-8')).hexdigest()[:16], 16)
+    actual_hash = xxhash.xxh3_64_intdigest(SAFETY_HASH_LINE_RE.sub(b'', raw))
     if given_hash == CFG_BYPASS_HASH:
         print('WARNING: Bypassing instrument config hash check; '
               f'actual is 0x{actual_hash:x}.', file=sys.stderr)
@@ -257,21 +347,48 @@ def power_reset_cycle(
     reset(instrs, psu_configs, True, t_rst)
 
 
+# Return channels of one supply to measure current of and those to measure voltage of
+def meas_channels(psu_config: PsuConfig, measure_all: bool = False) -> (list, list):
+    chans = [cidx for cidx, ccfg in psu_config.channels.items() if ccfg.measure or measure_all]
+    vol_chans = [cidx for cidx in chans if psu_config.channels[cidx].measure_vol]
+    return chans, vol_chans
+
+
+# Assemble per-channel measurement results of one supply
+def meas_result(chans: list, curs: list, vol_chans: list, vols: list) -> dict:
+    ret = {cidx: {'cur': cur} for cidx, cur in zip(chans, curs)}
+    for cidx, vol in zip(vol_chans, vols):
+        ret[cidx]['vol'] = vol
+    return ret
+
+
+# Measure out the specified channels of one supply. All channels are queried at
+# once unless the supply rejected channel lists before; then we query one by one.
+def meas_psu_vol_cur(instr: Instr, psu_config: PsuConfig, measure_all: bool = False) -> dict:
+    chans, vol_chans = meas_channels(psu_config, measure_all)
+    curs, vols = None, None
+    if chans and instr.resource_name not in NO_CHANLIST_INSTRS:
+        try:
+            curs = meas_pchs_vol_or_cur(instr, 'CURR', chans)
+            vols = meas_pchs_vol_or_cur(instr, 'VOLT', vol_chans) if vol_chans else []
+        except (vs.errors.VisaIOError, ValueError):
+            print(f'WARNING: {instr.resource_name} rejected channel list measurement; '
+                  'measuring channels one by one.', file=sys.stderr)
+            NO_CHANLIST_INSTRS.add(instr.resource_name)
+            instr.write('*CLS')
+    if curs is None or vols is None:
+        curs = [meas_pch_vol_or_cur(instr, 'CURR', cidx) for cidx in chans]
+        vols = [meas_pch_vol_or_cur(instr, 'VOLT', cidx) for cidx in vol_chans]
+    return meas_result(chans, curs, vol_chans, vols)
+
+
 # Measure out all supplies specified
 def meas_vol_cur(instrs: dict, psu_configs: dict, measure_all: bool = False) -> dict:
     ret = {}
-    # Measure
     for pname, pcfg in psu_configs.items():
-        for cidx, ccfg in pcfg.channels.items():
-            if not ccfg.measure and not measure_all:
-                continue
-            if pname not in ret:
-                ret[pname] = {}
-            if cidx not in ret[pname]:
-                ret[pname][cidx] = {}
-            ret[pname][cidx]['cur'] = meas_pch_vol_or_cur(instrs[pname], 'CURR', cidx)
-            if ccfg.measure_vol:
-                ret[pname][cidx]['vol'] = meas_pch_vol_or_cur(instrs[pname], 'VOLT', cidx)
+        pmeas = meas_psu_vol_cur(instrs[pname], pcfg, measure_all)
+        if pmeas:
+            ret[pname] = pmeas
     return ret
 
 
@@ -302,3 +419,174 @@ def reconf_siggens(
         if rst_instr:
             reset_instr(instrs[gname])
         set_siggen_source_configs(instrs[gname], gcfg.sources)
+
+
+# ==========================
+#    Async Socket Methods
+# ==========================
+
+# Raw SCPI socket port of Agilent instruments
+SCPI_SOCKET_PORT = 5025
+SCPI_SOCKET_TIMEOUT = 2.0
+
+
+# Minimal SCPI client over a raw TCP socket. Unlike PyVISA, its methods are
+# coroutines running on the event loop, so no executor threads are needed.
+class AsyncScpiInstr:
+    def __init__(self, ip: str, port: int = SCPI_SOCKET_PORT, timeout: float = SCPI_SOCKET_TIMEOUT):
+        self.ip = ip
+        self.port = port
+        self.timeout = timeout
+        self.resource_name = f'TCPIP0::{ip}::{port}::SOCKET'
+        self._reader = None
+        self._writer = None
+        self._lock = None
+
+    async def connect(self):
+        await self._open()
+        # Responses must be read in the order queries were sent
+        self._lock = asyncio.Lock()
+
+    async def _open(self):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.ip, self.port), self.timeout)
+
+    async def write(self, cmd: str):
+        async with self._lock:
+            self._writer.write(cmd.encode('ascii') + b'\n')
+            await self._writer.drain()
+
+    async def query(self, cmd: str) -> str:
+        async with self._lock:
+            self._writer.write(cmd.encode('ascii') + b'\n')
+            await self._writer.drain()
+            try:
+                resp = await asyncio.wait_for(self._reader.readuntil(b'\n'), self.timeout)
+            except asyncio.TimeoutError:
+                # A late response would be read by the next query; start over on a new connection
+                await self._reopen()
+                raise
+        return resp.decode('ascii').strip()
+
+    async def _reopen(self):
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except OSError:
+            pass
+        await self._open()
+
+    async def close(self):
+        self._writer.close()
+        await self._writer.wait_closed()
+
+
+# Connect to collection of instruments by their IP using raw SCPI sockets
+async def a_connect_instrs(configs: dict) -> dict:
+    instrs = {name: AsyncScpiInstr(cfg.ip) for name, cfg in configs.items()}
+    await asyncio.gather(*(instr.connect() for instr in instrs.values()))
+    return instrs
+
+
+async def a_set_pch_active(instr: AsyncScpiInstr, active: bool = True, channel: int = 0):
+    await instr.write(pch_active_cmd(active, channel))
+
+
+async def a_meas_pch_vol_or_cur(
+        instr: AsyncScpiInstr, tpe: str = 'VOLT', channel: int = 0) -> float:
+    return float(await instr.query(meas_query(tpe, [channel])))
+
+
+async def a_meas_pchs_vol_or_cur(
+        instr: AsyncScpiInstr, tpe: str = 'VOLT', channels: list = (0,)) -> list:
+    return meas_response(await instr.query(meas_query(tpe, channels)), len(channels))
+
+
+async def a_set_psu_channel_configs(
+        instr: AsyncScpiInstr, channel_configs: dict, toggle_output_state: bool = True):
+    if not channel_configs:
+        return
+    set_cmd, active_cmd = psu_channel_configs_cmds(channel_configs, toggle_output_state)
+    await instr.query(f'{set_cmd};*OPC?')
+    if active_cmd is not None:
+        await instr.write(active_cmd)
+
+
+async def a_reset_instr(instr: AsyncScpiInstr):
+    await instr.write('*RST')
+
+
+async def a_set_psu_opmode(instr: AsyncScpiInstr, opmode: str = 'OFF'):
+    await instr.write(psu_opmode_cmd(opmode))
+
+
+async def a_set_psu_gpio_state(instr: AsyncScpiInstr, pin: int = 1, val: bool = True):
+    await instr.write(psu_gpio_state_cmd(pin, val))
+
+
+# Set reset GPIOs of all PSUs having one concurrently
+async def a_set_reset_gpios(instrs: dict, psu_configs: dict, val: bool):
+    await asyncio.gather(*(
+        a_set_psu_gpio_state(instrs[name], cfg.reset_gpio, val)
+        for name, cfg in psu_configs.items() if cfg.reset_gpio))
+
+
+# Issue reset on all PSUs; see `reset`
+async def a_reset(
+        instrs: dict, psu_configs: dict, initial_low: bool = False, t_rst: float = 0.1):
+    if not initial_low:
+        await a_set_reset_gpios(instrs, psu_configs, True)
+    await a_set_reset_gpios(instrs, psu_configs, False)
+    await asyncio.sleep(t_rst)
+    await a_set_reset_gpios(instrs, psu_configs, True)
+
+
+# Power off all PSUs; see `power_off`
+async def a_power_off(instrs: dict, psu_configs: dict, ganged: bool = True):
+    if ganged:
+        await a_set_pch_active(next(iter(instrs.values())), False)
+    else:
+        await asyncio.gather(*(a_set_pch_active(instrs[name], False) for name in psu_configs))
+
+
+# Reset and reapply config of one PSU
+async def a_reconf_psu(
+        instr: AsyncScpiInstr, psu_config: PsuConfig, ganged: bool = True, rst_instr: bool = True):
+    if rst_instr:
+        await a_reset_instr(instr)
+    if None not in psu_config.channels:
+        await a_set_psu_opmode(instr, psu_config.opmode)
+    await a_set_psu_channel_configs(instr, psu_config.channels, not ganged)
+
+
+# Power-cycle all supplies, reapplying config, and assert reset(s); see `power_reset_cycle`.
+# The supplies are reconfigured concurrently.
+async def a_power_reset_cycle(
+        instrs: dict, psu_configs: dict, ganged: bool = True,
+        t_rst: float = 0.1, rst_instr: bool = True):
+    await a_power_off(instrs, psu_configs, ganged)
+    await asyncio.gather(*(
+        a_reconf_psu(instrs[name], cfg, ganged, rst_instr) for name, cfg in psu_configs.items()))
+    if ganged:
+        await a_set_pch_active(next(iter(instrs.values())), True)
+    await a_reset(instrs, psu_configs, True, t_rst)
+
+
+# Measure out the specified channels of one supply; see `meas_psu_vol_cur`
+async def a_meas_psu_vol_cur(
+        instr: AsyncScpiInstr, psu_config: PsuConfig, measure_all: bool = False) -> dict:
+    chans, vol_chans = meas_channels(psu_config, measure_all)
+    curs, vols = None, None
+    if chans and instr.resource_name not in NO_CHANLIST_INSTRS:
+        try:
+            curs = await a_meas_pchs_vol_or_cur(instr, 'CURR', chans)
+            vols = await a_meas_pchs_vol_or_cur(instr, 'VOLT', vol_chans) if vol_chans else []
+        except (asyncio.TimeoutError, ValueError):
+            print(f'WARNING: {instr.resource_name} rejected channel list measurement; '
+                  'measuring channels one by one.', file=sys.stderr)
+            NO_CHANLIST_INSTRS.add(instr.resource_name)
+            await instr.write('*CLS')
+    if curs is None or vols is None:
+        curs = [await a_meas_pch_vol_or_cur(instr, 'CURR', cidx) for cidx in chans]
+        vols = [await a_meas_pch_vol_or_cur(instr, 'VOLT', cidx) for cidx in vol_chans]
+    return meas_result(chans, curs, vol_chans, vols)
@@ -6,25 +6,43 @@
 
 # Coroutines attaching to, logging, and handling UART commands.
 
+import os
 import re
+import json
+import math
+import time
 import pathlib
 import asyncio
 import signal
-import json
 from subprocess import PIPE
+from collections import deque
+from dataclasses import replace
+from concurrent.futures import Executor, ThreadPoolExecutor
 from ast import literal_eval
 from pprint import pprint
-import aiofiles
+import orjson
 import serial_asyncio
 
 from dutctl import aginstr
 
 
 # Parse to specific literal (e.g. hex, int, float, list, ...) if possible, otherwise return input.
+# Plain decimal numbers are by far most common, so we try builtin conversions first.
 def literal_or_str(expr: str):
     try:
-        return literal_eval(expr)
+        return int(expr)
     except ValueError:
+        pass
+    try:
+        val = float(expr)
+        # Leave special values (e.g. `nan`, `inf`) to `literal_eval` as before
+        if math.isfinite(val):
+            return val
+    except ValueError:
+        pass
+    try:
+        return literal_eval(expr)
+    except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
         return expr
 
 
@@ -41,24 +59,107 @@ def ensure_par_dir_exists(file_path: str):
     path_obj.parent.mkdir(exist_ok=True, parents=True)
 
 
+# Queued chunks are written out in batches of limited count and size
+WRITE_BATCH_CHUNKS = 32
+WRITE_BATCH_SIZE = 64 * 1024
+
+# Batches are gathered with `writev` where available
+HAVE_WRITEV = hasattr(os, 'writev')
+# The limit is -1 if indeterminate; fall back to the POSIX minimum then
+IOV_MAX = os.sysconf('SC_IOV_MAX') if 'SC_IOV_MAX' in getattr(os, 'sysconf_names', {}) else -1
+if IOV_MAX <= 0:
+    IOV_MAX = 16
+
+
+# Writes a file from a dedicated task. Writes are queued without awaiting and issued
+# with plain `os.write`, as the page cache absorbs them without blocking in practice.
+class FileWriter:
+    def __init__(self, path: str):
+        self.path = path
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    async def __aenter__(self):
+        ensure_par_dir_exists(self.path)
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self._task = asyncio.create_task(self._write_queued(fd))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._queue.put_nowait(None)
+        await self._task
+
+    def write(self, data: bytes):
+        self._queue.put_nowait(data)
+
+    # Take all immediately available chunks up to the batch limits, stopping at `None`
+    def _get_batch(self, first: bytes) -> (list, bool):
+        bufs = [first]
+        size = len(first)
+        while not self._queue.empty() and len(bufs) < WRITE_BATCH_CHUNKS \
+                and size < WRITE_BATCH_SIZE:
+            data = self._queue.get_nowait()
+            if data is None:
+                return bufs, True
+            bufs.append(data)
+            size += len(data)
+        return bufs, False
+
+    async def _write_queued(self, fd: int):
+        try:
+            done = False
+            while not done and (data := await self._queue.get()) is not None:
+                bufs, done = self._get_batch(data)
+                write_all(fd, bufs)
+        # If cancelled, still write out what was queued before closing
+        finally:
+            bufs = []
+            while not self._queue.empty():
+                data = self._queue.get_nowait()
+                if data is not None:
+                    bufs.append(data)
+            write_all(fd, bufs)
+            os.close(fd)
+
+
+# Write all of the given chunks to a file descriptor in as few syscalls as possible,
+# resuming after short writes. Chunks are gathered by the kernel, never concatenated.
+def write_all(fd: int, bufs: list):
+    views = [memoryview(b) for b in bufs if len(b)]
+    while views:
+        if HAVE_WRITEV:
+            written = os.writev(fd, views[:IOV_MAX])
+        else:
+            written = os.write(fd, views[0])
+        # Drop fully written chunks, then trim partially written one
+        while views and written >= len(views[0]):
+            written -= len(views[0])
+            views.pop(0)
+        if written:
+            views[0] = views[0][written:]
+
+
 # Spawn and wait on subprocess outputting to file
 async def async_subproc(
         end_event: asyncio.Event, argv: list, out_path: str,
-        poll_period: float, sig: int = None, mask_return: int = None) -> int:
-    assert poll_period > 0
+        sig: int = None, mask_return: int = None) -> int:
     ensure_par_dir_exists(out_path)
-    async with aiofiles.open(out_path, 'w+') as f:
+    # The subprocess writes to the file directly; we only hand it the descriptor
+    with open(out_path, 'w+', encoding='utf-8') as f:
         p = await asyncio.create_subprocess_exec(*argv, stdin=PIPE, stdout=f, stderr=f)
-        while p.returncode is None:
-            if end_event.is_set():
-                if sig is None:
-                    p.terminate()
-                else:
-                    p.send_signal(sig)
-                await p.wait()
-                assert p.returncode is not None
+        # Race process termination against end event; no polling needed
+        wait_task = asyncio.create_task(p.wait())
+        end_task = asyncio.create_task(end_event.wait())
+        await asyncio.wait({wait_task, end_task}, return_when=asyncio.FIRST_COMPLETED)
+        if wait_task.done():
+            end_task.cancel()
+        else:
+            if sig is None:
+                p.terminate()
             else:
-                await asyncio.sleep(poll_period)
+                p.send_signal(sig)
+            await wait_task
+        assert p.returncode is not None
         # If this process is first to terminate: propagate end signal
         if not end_event.is_set():
             end_event.set()
@@ -72,38 +173,115 @@ async def async_subproc(
 #    Measurement
 # =================
 
-# First JSON measurement needs no comma before it
-FIRST_JSON_MEAS = True
+# Whether to pretty-print measurements to stdout
+PPRINT_MEAS = False
+
+# Measurements may have non-string (e.g. channel index) keys; each is written as one line
+MEAS_JSON_OPTS = orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE
+
+# Measurements are buffered and written out once either budget is exceeded
+MEAS_FLUSH_SIZE = 64 * 1024
+MEAS_FLUSH_INTERVAL = 1.0
+
+
+# Writes a measurement file, buffering writes up to a size and time budget.
+# A background task writes out partial buffers after the time budget elapses.
+class MeasFile(FileWriter):
+    def __init__(
+            self, path: str, flush_size: int = MEAS_FLUSH_SIZE,
+            flush_interval: float = MEAS_FLUSH_INTERVAL):
+        super().__init__(path)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._buf = bytearray()
+        self._last_flush = 0.0
+        self._flush_task = None
+
+    async def __aenter__(self):
+        await super().__aenter__()
+        self._last_flush = time.monotonic()
+        self._flush_task = asyncio.create_task(self._flush_periodically())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._flush_task.cancel()
+        self.flush()
+        await super().__aexit__(*exc_info)
+
+    def write(self, data: bytes):
+        self._buf += data
+        if len(self._buf) >= self.flush_size or \
+                time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if self._buf:
+            super().write(bytes(self._buf))
+            self._buf.clear()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+
+
+async def write_out_meas(meas: dict, meas_file: MeasFile = None):
+    # Pretty-printing is costly for nested measurements; only do it if asked to
+    if PPRINT_MEAS:
+        print('MEAS: ', end='')
+        pprint(meas)
+    else:
+        print(f'MEAS: {meas}')
+    if meas_file is not None:
+        try:
+            data = orjson.dumps(meas, option=MEAS_JSON_OPTS)
+        except orjson.JSONEncodeError:
+            # orjson rejects integers beyond 64 bits, which DUT results may contain
+            data = json.dumps(meas, separators=(',', ':')).encode() + b'\n'
+        meas_file.write(data)
+
+
+# Measure one supply. Socket instruments are awaited natively, while we run
+# TCP-blocking VISA measurements in an executor to be able to await them.
+async def async_meas_psu(instr, psu_config: aginstr.PsuConfig, executor: Executor = None):
+    if isinstance(instr, aginstr.AsyncScpiInstr):
+        return await aginstr.a_meas_psu_vol_cur(instr, psu_config)
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, aginstr.meas_psu_vol_cur, instr, psu_config)
 
 
-async def write_out_meas(meas: dict, async_file=None):
-    global FIRST_JSON_MEAS   # pylint: disable=global-statement
-    meas_str = json.dumps(meas)
-    print('MEAS: ', end='')
-    pprint(meas)
-    if async_file is not None:
-        await async_file.write(('' if FIRST_JSON_MEAS else ',') + '\n' + meas_str)
-        FIRST_JSON_MEAS = False
+async def async_meas(
+        psu_instrs: dict, psu_configs: dict, meas_file: MeasFile = None,
+        name: str = None, executor: Executor = None):
+    # Each supply is measured separately so that independent instruments overlap
+    pmeas = await asyncio.gather(*(
+        async_meas_psu(psu_instrs[pname], pcfg, executor)
+        for pname, pcfg in psu_configs.items()))
+    meas_dat = {pname: dat for pname, dat in zip(psu_configs, pmeas) if dat}
+    await write_out_meas({name: meas_dat}, meas_file)
 
 
-async def async_meas(psu_instrs: dict, psu_configs: dict, async_file=None, name: str = None):
-    # We run the TCP-blocking measurement in an executor to be able to await it
-    meas_dat = await asyncio.get_running_loop().run_in_executor(
-        None, aginstr.meas_vol_cur, psu_instrs, psu_configs)
-    await write_out_meas({name: meas_dat}, async_file)
+# Decode a received line for printing
+def line_str(line: bytes) -> str:
+    return line.decode('utf-8', 'replace')
+
+
+# Compile (bytes) pattern for PSU control or measurement lines of the given tool name
+def compile_psuline_re(name: str, tname: str) -> re.Pattern:
+    return re.compile(
+        rf'@{re.escape(tname)}:psu{name}:([^:]+):(\d+)(?::([^:\r\n]+))?(?::(\d+))?'.encode())
 
 
 async def parse_psuline(
-        name: str, line: str, line_queue: asyncio.Queue,
-        psu_configs: dict, tname: str) -> (bool, tuple, dict):
-    psuline = re.match(
-        '@' + tname + ':psu' + name + r':([^:]+):(\d+)(?::([^:\r\n]+))?(?::(\d+))?', line)
+        name: str, psuline_re: re.Pattern, line: bytes, psu_configs: dict) -> (bool, tuple, dict):
+    psuline = psuline_re.match(line)
     if psuline is None or len(psuline.groups()) != 4 or \
             (name == 'ctl' and try_float(psuline.groups()[0]) is None):
-        print(f'ERROR: malformed PSU {name} line (ignored): {line}')
-        line_queue.task_done()
+        print(f'ERROR: malformed PSU {name} line (ignored): {line_str(line)}')
         return (False, None, None)
-    psuline = psuline.groups()
+    # Only decode the matched fields
+    psuline = tuple(None if grp is None else line_str(grp) for grp in psuline.groups())
     psu_configs_loc = psu_configs
     # Filter supply for line if specified
     if psuline[2] is not None:
@@ -112,26 +290,26 @@ async def parse_psuline(
             psu_configs_loc = {supply: psu_configs[supply]}
         except KeyError:
             print(f'ERROR: unknown supply `{supply}` '
-                  f' in PSU {name} line (ignored): {line}')
-            line_queue.task_done()
+                  f' in PSU {name} line (ignored): {line_str(line)}')
             return (False, None, None)
         # Filter channel for line if specified
         if psuline[3] is not None:
             cidx = int(psuline[3])
+            psu_config = psu_configs_loc[supply]
             try:
-                psu_configs_loc[supply].channels = \
-                    {cidx: psu_configs_loc[supply].channels[cidx]}
+                channel = psu_config.channels[cidx]
                 # if control line, edit voltage
                 if name == 'ctl':
-                    psu_configs_loc[supply].channels[cidx].vol = float(psuline[0])
+                    channel = replace(channel, vol=float(psuline[0]))
+                # Filter copies so the shared configs are left intact
+                psu_configs_loc[supply] = replace(psu_config, channels={cidx: channel})
             except KeyError:
                 print(f'ERROR: unknown channel `{cidx}` '
-                      f'in PSU {name} line (ignored): {line}')
-                line_queue.task_done()
+                      f'in PSU {name} line (ignored): {line_str(line)}')
                 return (False, None, None)
     # Sleep for specified time before line
     await asyncio.sleep(1e-3 * float(psuline[1]))
-    # Let main flow take over from here; don't forget to signal `task_done`!
+    # Let main flow take over from here
     return True, psuline, psu_configs_loc
 
 
@@ -139,87 +317,150 @@ async def parse_psuline(
 #    UART
 # ==========
 
+# Maximum number of bytes read from UART at once
+UART_READ_SIZE = 4096
+
+
+# Passes control lines from the UART reader to the control line handler. As there
+# is exactly one producer and consumer, a deque and a wakeup event suffice.
+class LineChannel:
+    def __init__(self):
+        self._lines = deque()
+        self._event = asyncio.Event()
+        self._closed = False
+        self._waiting = False
+
+    # Whether the consumer is waiting for lines, i.e. none are pending or processed
+    @property
+    def idle(self) -> bool:
+        return self._waiting and not self._lines
+
+    def put_nowait(self, line: bytes):
+        self._lines.append(line)
+        self._event.set()
+
+    # Returns `None` once the channel is closed and has no lines left
+    async def get(self) -> bytes:
+        while not self._lines:
+            if self._closed:
+                return None
+            self._event.clear()
+            self._waiting = True
+            try:
+                await self._event.wait()
+            finally:
+                self._waiting = False
+        return self._lines.popleft()
+
+    def close(self):
+        self._closed = True
+        self._event.set()
+
+    # Remove and return all pending lines
+    def drain(self) -> list:
+        lines = list(self._lines)
+        self._lines.clear()
+        return lines
+
+
 async def uart_handle_control_lines(
-        end_event: asyncio.Event, meas_path: str, line_queue: asyncio.Queue,
-        psu_instrs: dict, psu_configs: dict, tname: str):
-    ensure_par_dir_exists(meas_path)
-    with open(meas_path, 'w+', encoding='utf-8') as meas_file:
-        meas_file.write('[')
+        end_event: asyncio.Event, meas_path: str, line_queue: LineChannel,
+        psu_instrs: dict, psu_configs: dict, tname: str, meas_executor: Executor):
+    # Precompute (bytes) patterns once for the tool name
+    tname_pfx = f'@{tname}'.encode()
+    dutmeas_re = re.compile(rf'@{re.escape(tname)}:dutmeas:([^:]+):([^\r\n]+)'.encode())
+    psuctl_re = compile_psuline_re('ctl', tname)
+    psumeas_re = compile_psuline_re('meas', tname)
+
+    async def handle_dutmeas(line: bytes, meas_file: MeasFile):
+        dutmeas = dutmeas_re.match(line)
+        if dutmeas is None or len(dutmeas.groups()) != 2:
+            print(f'ERROR: malformed DUT measurement line (ignored): {line_str(line)}')
+            return
+        key, val = (line_str(grp) for grp in dutmeas.groups())
+        await write_out_meas({key: literal_or_str(val)}, meas_file)
+
+    async def handle_psuctl(line: bytes, _: MeasFile):
+        valid, psumeas, psu_configs_loc = await parse_psuline('ctl', psuctl_re, line, psu_configs)
+        if not valid:
+            return
+        # Control and return
+        print(f'PSUCFG: {psumeas}')
+        for name, cfg in psu_configs_loc.items():
+            instr = psu_instrs[name]
+            if isinstance(instr, aginstr.AsyncScpiInstr):
+                await aginstr.a_set_psu_channel_configs(instr, cfg.channels, False)
+            else:
+                aginstr.set_psu_channel_configs(instr, cfg.channels, False)
+
+    async def handle_psumeas(line: bytes, meas_file: MeasFile):
+        valid, psumeas, psu_configs_loc = await parse_psuline(
+            'meas', psumeas_re, line, psu_configs)
+        if not valid:
+            return
+        # Measure and return
+        await async_meas(psu_instrs, psu_configs_loc, meas_file, psumeas[0], meas_executor)
+
+    # Dispatch on the command field, i.e. the second colon-separated one
+    handlers = {b'dutmeas': handle_dutmeas, b'psuctl': handle_psuctl, b'psumeas': handle_psumeas}
     try:
-        async with aiofiles.open(meas_path, 'a') as meas_file:
-            while not end_event.is_set():
-                line = await line_queue.get()
-                if line.startswith(f'@{tname}:dutmeas:'):
-                    dutmeas = re.match('@' + tname + r':dutmeas:([^:]+):([^\r\n]+)', line)
-                    if dutmeas is None or len(dutmeas.groups()) != 2:
-                        print(f'ERROR: malformed DUT measurement line (ignored): {line}')
-                        line_queue.task_done()
-                        continue
-                    dutmeas = dutmeas.groups()
-                    await write_out_meas({dutmeas[0]: literal_or_str(dutmeas[1])}, meas_file)
-                elif line.startswith(f'@{tname}:psuctl:'):
-                    valid, psumeas, psu_configs_loc = await parse_psuline(
-                        'ctl', line, line_queue, psu_configs, tname)
-                    if not valid:
-                        continue
-                    # Control and return
-                    print(f'PSUCFG: {psumeas}')
-                    for name, instr in psu_instrs.items():
-                        if name in psu_configs_loc:
-                            aginstr.set_psu_channel_configs(
-                                instr, psu_configs[name].channels, False)
-                elif line.startswith(f'@{tname}:psumeas:'):
-                    valid, psumeas, psu_configs_loc = await parse_psuline(
-                        'meas', line, line_queue, psu_configs, tname)
-                    if not valid:
-                        continue
-                    # Measure and return
-                    await async_meas(psu_instrs, psu_configs_loc, meas_file, psumeas[0])
+        async with MeasFile(meas_path) as meas_file:
+            while not end_event.is_set() and (line := await line_queue.get()) is not None:
+                parts = line.split(b':', 2)
+                handler = handlers.get(parts[1]) \
+                    if len(parts) == 3 and parts[0] == tname_pfx else None
+                if handler is None:
+                    print(f'ERROR: malformed control line (ignored): {line_str(line)}')
                 else:
-                    print(f'ERROR: malformed control line (ignored): {line}')
-                line_queue.task_done()
+                    await handler(line, meas_file)
     # The task is ending or was cancelled. Pop remaining events and warn for each
     finally:
-        with open(meas_path, 'a', encoding='utf-8') as meas_file:
-            meas_file.write('\n]\n')
-        while not line_queue.empty():
-            line = await line_queue.get()
-            print(f'ERROR: terminated before processing control line (ignored): {line}')
-            line_queue.task_done()
+        for line in line_queue.drain():
+            print('ERROR: terminated before processing control line '
+                  f'(ignored): {line_str(line)}')
 
 
 async def uart_handle_serial(
-        line_queue: asyncio.Queue(), uart_dev: str,
+        line_queue: LineChannel, uart_dev: str,
         out_path: str, baudrate: int, tname: str):
     reader, _ = await serial_asyncio.open_serial_connection(url=uart_dev, baudrate=baudrate)
-    ensure_par_dir_exists(out_path)
-    async with aiofiles.open(out_path, 'w+') as out_file:
+    prefix = f'@{tname}'.encode()
+    buf = bytearray()
+    async with FileWriter(out_path) as out_file:
         while True:
-            line = str(await reader.readline(),  encoding='utf-8')
-            # Handle and write any existing IO lines
-            if line.startswith(f'@{tname}'):
-                line_stripped = line.rstrip()
-                line_queue.put_nowait(line_stripped)
-            await out_file.write(line)
+            # Read and log whatever is available in one go, then split off lines
+            chunk = await reader.read(UART_READ_SIZE)
+            if not chunk:
+                break
+            out_file.write(chunk)
+            buf += chunk
+            while (nl := buf.find(b'\n')) >= 0:
+                # Handle any complete IO lines; they stay bytes until fields are parsed
+                if buf.startswith(prefix, 0, nl):
+                    line_queue.put_nowait(bytes(buf[:nl]).rstrip())
+                del buf[:nl+1]
 
 
 async def handle_uart(
         end_event: asyncio.Event, uart_dev: str, meas_path: str, out_path: str, psu_instrs: dict,
-        psu_configs: dict, baudrate: int, poll_period: float, tname: str) -> int:
-    line_queue = asyncio.Queue()
+        psu_configs: dict, baudrate: int, tname: str) -> int:
+    line_queue = LineChannel()
+    # Measure on dedicated threads, one per supply, not blocked by other executor work
+    meas_executor = ThreadPoolExecutor(max_workers=max(1, len(psu_instrs)))
     # Spawn tasks
     uart_task = asyncio.get_running_loop().create_task(uart_handle_serial(
         line_queue, uart_dev, out_path, baudrate, tname))
     control_task = asyncio.get_running_loop().create_task(uart_handle_control_lines(
-        end_event, meas_path, line_queue, psu_instrs, psu_configs, tname))
+        end_event, meas_path, line_queue, psu_instrs, psu_configs, tname, meas_executor))
     # Await end event
-    while not end_event.is_set():
-        await asyncio.sleep(poll_period)
-    # Cancel tasks
+    await end_event.wait()
+    # Cancel reader, then let control task finish current line and warn for pending ones
     uart_task.cancel()
-    if not control_task.done():
+    if not line_queue.idle:
         print('INFO: termination awaiting pending measurements; consider prolonging computation')
-        await line_queue.join()
+    line_queue.close()
+    await control_task
+    meas_executor.shutdown(wait=False)
     # There is no failure non-exception failure condition here
     return 0
 
@@ -230,9 +471,9 @@ async def handle_uart(
 
 async def handle_gdb(
         end_event: asyncio.Event, binary: str, script_path: str,
-        out_path: str, poll_period: float) -> int:
+        out_path: str) -> int:
     return await async_subproc(
-        end_event, [binary, '-x', script_path], out_path, poll_period, sig=signal.SIGKILL)
+        end_event, [binary, '-x', script_path], out_path, sig=signal.SIGKILL)
 
 
 # =============
@@ -241,6 +482,6 @@ async def handle_gdb(
 
 async def handle_ocd(
         end_event: asyncio.Event, binary: str, script_path: str,
-        out_path: str, poll_period: float) -> int:
+        out_path: str) -> int:
     return await async_subproc(
-        end_event, [binary, '-f', script_path], out_path, poll_period, mask_return=-15)
+        end_event, [binary, '-f', script_path], out_path, mask_return=-15)
@@ -8,11 +8,12 @@
 # dutctl: control a device under test and its instruments remotely.
 
 import os
+import re
 import time
 import argparse
 import pathlib
-import functools
 import asyncio
+from collections import namedtuple
 import pyvisa as vs
 
 from dutctl import aginstr
@@ -28,16 +29,89 @@ OCD_ACTIONS = ('reset', 'cycle', 'run')
 DEF_GDB = 'riscv64-unknown-elf-gdb'
 DEF_OCD = 'openocd'
 
+# Names of per-chip arguments, also used to name their tasks and logs
+ChipKeys = namedtuple('ChipKeys', 'ocd gdb uart')
 
-# Global event to terminate program
-end_event = asyncio.Event()
+# Full-line comments in argument files
+FILE_COMMENT_RE = re.compile(r'^#.*$', re.MULTILINE)
+
+
+# Global event to terminate program. It is created by the entry point on the running
+# loop, as the end event is awaited and an event bound to another loop cannot be.
+end_event: asyncio.Event = None  # pylint: disable=invalid-name
+
+
+# Add the arguments specific to one chip to the parser
+def add_chip_args(parser: argparse.ArgumentParser, chip: int, keys: ChipKeys):
+    group = parser.add_argument_group(
+        f'Chip {chip}', f'Arguments specific to chip {chip} of the DUT (see `-n` option)')
+    # With no file argument, we store whether the flag was passed or not (True/False).
+    # We infer from this whether OpenOCD should be run and override the path later.
+    group.add_argument(
+        f'-o{chip}', f'--{keys.ocd}', nargs='?', metavar="OCDCFG",
+        help=f'Runs OpenOCD with the passed config file. '
+        f'Usable with the actions {", ".join(OCD_ACTIONS)}. '
+        f'The default argument is `<workdir>/common/chip{chip}.ocd`. '
+        f'OpenOCD output is logged to `<logdir>/{keys.ocd}.log.` '
+        f'Terminates {TOOL_NAME} if and when OpenOCD does.',
+        const=True, default=False)
+    group.add_argument(
+        f'-g{chip}', f'--{keys.gdb}', nargs='?', metavar="GDBSCRIPT",
+        help=f'Runs GDB with the passed script. Usable only with the action run. '
+        f'Implies `--{keys.ocd}` with its default argument if not passed. '
+        f'GDB output is logged to `<logdir>/{keys.gdb}.log.` '
+        f'Terminates {TOOL_NAME} if and when GDB or OpenOCD do.')
+    group.add_argument(
+        f'-u{chip}', f'--{keys.uart}', nargs='?', metavar="UARTDEV[:BAUDRATE]",
+        help=f'Observe the output of the passed serial device (default baudrate {DEF_BAUD}) '
+        f'and log it to `<logdir>/{keys.uart}.log`. Usable only with the action run. If passed,'
+        f' the received output can trigger PSU measurements with control lines of the format '
+        f'`@{TOOL_NAME}:psumeas:<key>:<delay_ms>[:<supply>[:<channel>]]`. It can also add '
+        f' computed results to the measurement JSON with control lines of the format '
+        f'`@{TOOL_NAME}:dutmeas:<key>:<result_string>`.'
+        f' The control lines take effect when their trailing newline (`\\n`) is received.')
+
+
+# Set default OCD configs where implied, then check that all needed files exist
+def expand_and_check_files(
+        parser: argparse.ArgumentParser, args: argparse.Namespace, default_cfg_dir: pathlib.Path):
+    must_exist_files = [args.instr]
+    for d, (ocd, gdb) in enumerate(zip(args.ocds, args.gdbs)):
+        # If --ocd{d} is implicit through --gdb{d} or explicit without arg: set default file.
+        if (gdb is not None and ocd is False) or ocd is True:
+            args.ocds[d] = default_cfg_dir/f'chip{d}.ocd'
+            must_exist_files.append(args.ocds[d])
+        # No file passed and none required: pass on None to signal that OCD shall not be launched.
+        elif ocd in (True, False):
+            args.ocds[d] = None
+        # A file is explicitly passed: do not override it and check its existence.
+        else:
+            must_exist_files.append(ocd)
+        # Any GDB file that is passed must exist. Otherwise, it is None and GDB is not launched.
+        if gdb is not None:
+            must_exist_files.append(gdb)
+    # Paths may repeat across chips; check each only once, in order
+    for f in dict.fromkeys(map(os.fspath, must_exist_files)):
+        if not os.path.isfile(f):
+            parser.error(f'File `{f}` does not exist')
+
+
+# Split UART args into path and baudrate, which defaults to `DEF_BAUD`
+def split_uart_args(parser: argparse.ArgumentParser, args: argparse.Namespace):
+    for d, uart in enumerate(args.uarts):
+        if uart is not None:
+            args.uarts[d], sep, baud = uart.partition(':')
+            if sep:
+                if not baud.isdigit():
+                    parser.error(f'Invalid baudrate `{baud}` for UART of chip {d}')
+                args.bauds[d] = int(baud)
 
 
 def parse_and_validate_args(args: list) -> argparse.Namespace:
     # Determine default directories
     working_dir = pathlib.Path(os.getcwd()).resolve()
     default_cfg_dir = working_dir / 'common'
-    default_log_leaf = f'{TOOL_NAME}_{int(1000*time.time())}'
+    default_log_leaf = f'{TOOL_NAME}_{time.time_ns() // 1_000_000}'
     default_log_dir = working_dir / 'logs' / default_log_leaf
 
     # Build pre-parser for meta-arguments, e.g. number of chips and file arguments
@@ -48,10 +122,9 @@ def parse_and_validate_args(args: list) -> argparse.Namespace:
     num_chips = meta_args.nchips
     file_args = []
     if meta_args.file is not None:
-        # Strip comments (begin with `#`), then put contents back together and split on whitespace.
+        # Strip comments (lines beginning with `#`) in one pass, then split on whitespace.
         # Note that we do *not* support end-of-line comments.
-        file_args_lines = [line for line in meta_args.file.readlines() if not line.startswith('#')]
-        file_args = '\n'.join(file_args_lines).strip().split()
+        file_args = FILE_COMMENT_RE.sub('', meta_args.file.read()).split()
         print(f'INFO: read file arguments: `{" ".join(file_args)}`')
 
     # Build base parser. Add (ignored) meta-args here for help.
@@ -74,7 +147,8 @@ def parse_and_validate_args(args: list) -> argparse.Namespace:
         help='Directory for logs. Created and used only when OCD is launched. '
         f'The default is a subdirectory of `<workdir>/logs` timestamped in the '
         f'format `{default_log_leaf}`. Measurements are both printed and, '
-        f'if triggered through serial output, written to `<logdir>/measure<chip>.json`.')
+        f'if triggered through serial output, written to `<logdir>/measure<chip>.json` '
+        f'as newline-delimited JSON (one object per measurement).')
     parser.add_argument(
         '-t', '--trst', metavar="SECS", default=0.1, type=float,
         help='Reset pulse width. The default is `0.1`.')
@@ -82,8 +156,8 @@ def parse_and_validate_args(args: list) -> argparse.Namespace:
         '-a', '--trafter', metavar="SECS", default=0.1, type=float,
         help='Time to wait after issuing the reset. The default is `0.1`.')
     parser.add_argument(
-        '-p', '--tpoll', metavar="SECS", default=0.5, type=float,
-        help='Polling period for subprocesses. The default is `0.5`.')
+        # Subprocesses and UARTs are event-driven; only accepted for compatibility
+        '-p', '--tpoll', metavar="SECS", default=0.5, type=float, help=argparse.SUPPRESS)
     parser.add_argument(
         '-s', '--tswait', metavar="SECS", default=0.5, type=float,
         help='Time to wait before standby measurement. The default is `0.5`.')
@@ -96,6 +170,14 @@ def parse_and_validate_args(args: list) -> argparse.Namespace:
     parser.add_argument(
         '-e', '--noreset', action='store_true',
         help='Do not send reset.')
+    parser.add_argument(
+        '-k', '--sockets', action='store_true',
+        help='Control and measure supplies from the event loop over raw SCPI sockets '
+        f'(port {aginstr.SCPI_SOCKET_PORT}) instead of VISA, handling multiple supplies '
+        'concurrently. Signal generators always use VISA.')
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='Pretty-print measurements.')
     parser.add_argument(
         '-b', '--ocdbin', metavar="BINARY", default=DEF_OCD,
         help='Binary for OpenOCD. Used only when OCD is launched. '
@@ -104,91 +186,105 @@ def parse_and_validate_args(args: list) -> argparse.Namespace:
         '-d', '--gdbbin', metavar="BINARY", default=DEF_GDB,
         help='Binary for GDB. Used only when GDB is launched. '
         f'The default is `{DEF_GDB}`. ')
-    for chip in range(num_chips):
-        group = parser.add_argument_group(
-            f'Chip {chip}', f'Arguments specific to chip {chip} of the DUT (see `-n` option)')
-        # With no file argument, we store whether the flag was passed or not (True/False).
-        # We infer from this whether OpenOCD should be run and override the path later.
-        group.add_argument(
-            f'-o{chip}', f'--ocd{chip}', nargs='?', metavar="OCDCFG",
-            help=f'Runs OpenOCD with the passed config file. '
-            f'Usable with the actions {", ".join(OCD_ACTIONS)}. '
-            f'The default argument is `<workdir>/common/chip{chip}.ocd`. '
-            f'OpenOCD output is logged to `<logdir>/ocd{chip}.log.` '
-            f'Terminates {TOOL_NAME} if and when OpenOCD does.',
-            const=True, default=False)
-        group.add_argument(
-            f'-g{chip}', f'--gdb{chip}', nargs='?', metavar="GDBSCRIPT",
-            help=f'Runs GDB with the passed script. Usable only with the action run. '
-            f'Implies `--ocd{chip}` with its default argument if not passed. '
-            f'GDB output is logged to `<logdir>/gdb{chip}.log.` '
-            f'Terminates {TOOL_NAME} if and when GDB or OpenOCD do.')
-        group.add_argument(
-            f'-u{chip}', f'--uart{chip}', nargs='?', metavar="UARTDEV[:BAUDRATE]",
-            help=f'Observe the output of the passed serial device (default baudrate {DEF_BAUD}) '
-            f'and log it to `<logdir>/uart{chip}.log`. Usable only with the action run. If passed,'
-            f' the received output can trigger PSU measurements with control lines of the format '
-            f'`@{TOOL_NAME}:psumeas:<key>:<delay_ms>[:<supply>[:<channel>]]`. It can also add '
-            f' computed results to the measurement JSON with control lines of the format '
-            f'`@{TOOL_NAME}:dutmeas:<key>:<result_string>`.'
-            f' The control lines take effect when their trailing newline (`\\n`) is received.')
+    chip_keys = [ChipKeys(f'ocd{d}', f'gdb{d}', f'uart{d}') for d in range(num_chips)]
+    for chip, keys in enumerate(chip_keys):
+        add_chip_args(parser, chip, keys)
 
     # Parse arguments
     args = parser.parse_args(args + file_args)
 
+    # Gather per-chip arguments into lists indexed by chip
+    args.chip_keys = chip_keys
+    args.ocds = [getattr(args, keys.ocd) for keys in chip_keys]
+    args.gdbs = [getattr(args, keys.gdb) for keys in chip_keys]
+    args.uarts = [getattr(args, keys.uart) for keys in chip_keys]
+    args.bauds = [DEF_BAUD] * num_chips
+
     # Check arguments
     if args.action not in ACTIONS:
         parser.error(f'action must be one of: {", ".join(ACTIONS)}.')
     if args.action == 'run':
-        if all((vars(args)[f'gdb{d}'] is None) for d in range(num_chips)):
+        if all(gdb is None for gdb in args.gdbs):
             parser.error('action run requires OpenOCD and GDB scripts for at least one chip.')
     else:
-        if any((vars(args)[f'gdb{d}'] is not None
-                or vars(args)[f'uart{d}'] is not None) for d in range(num_chips)):
+        if any(gdb is not None or uart is not None for gdb, uart in zip(args.gdbs, args.uarts)):
             parser.error('GDB or UART output observation require action run.')
-    if args.action not in OCD_ACTIONS and any(
-            (vars(args)[f'ocd{d}'] is not False) for d in range(num_chips)):
+    if args.action not in OCD_ACTIONS and any(ocd is not False for ocd in args.ocds):
         parser.error(f'Launching OpenOCD requires one of the actions {", ".join(OCD_ACTIONS)}.')
 
     # Extend default args as necessary, check that needed files exist
-    must_exist_files = [args.instr]
-    for d in range(num_chips):
-        # If --ocd{d} is implicit through --gdb{d} or explicit without arg: set default file.
-        if (vars(args)[f'gdb{d}'] is not None and vars(args)[f'ocd{d}'] is False) \
-                or vars(args)[f'ocd{d}'] is True:
-            vars(args)[f'ocd{d}'] = default_cfg_dir/f'chip{d}.ocd'
-            must_exist_files.append(vars(args)[f'ocd{d}'])
-        # No file passed and none required: pass on None to signal that OCD shall not be launched.
-        elif vars(args)[f'ocd{d}'] in (True, False):
-            vars(args)[f'ocd{d}'] = None
-        # A file is explicitly passed: do not override it and check its existence.
-        else:
-            must_exist_files.append(vars(args)[f'ocd{d}'])
-        # Any GDB file that is passed must exist. Otherwise, it is None and GDB is not launched.
-        if vars(args)[f'gdb{d}'] is not None:
-            must_exist_files.append(vars(args)[f'gdb{d}'])
-    for f in must_exist_files:
-        if not pathlib.Path(f).is_file():
-            parser.error(f'File `{f}` does not exist')
+    expand_and_check_files(parser, args, default_cfg_dir)
 
     # Split UART args into path and baudrate
-    for d in range(num_chips):
-        vars(args)[f'baud{d}'] = DEF_BAUD
-        if vars(args)[f'uart{d}'] is not None and ':' in vars(args)[f'uart{d}']:
-            vars(args)[f'uart{d}'], vars(args)[f'baud{d}'] = vars(args)[f'uart{d}'].split(':')
+    split_uart_args(parser, args)
 
     # Return arguments
     return args
 
 
+# Wrap a blocking function so it can be awaited like its socket-based variant;
+# it runs in a worker thread so the event loop is not blocked meanwhile
+def awaitable(func):
+    async def wrapper(*args):
+        return await asyncio.to_thread(func, *args)
+    return wrapper
+
+
+# Apply a blocking function to each configured instrument concurrently in worker threads
+async def per_instr(func, instrs: dict, cfgs: dict, *args):
+    await asyncio.gather(*(
+        asyncio.to_thread(func, instrs, {name: cfg}, *args) for name, cfg in cfgs.items()))
+
+
+# Connect to supplies, returning them with matching awaitable (reset, power_off,
+# power_reset_cycle) functions; sockets are used if requested, VISA otherwise
+async def connect_psus(rm: vs.ResourceManager, psu_cfgs: dict, sockets: bool) -> (dict, tuple):
+    if sockets:
+        return await aginstr.a_connect_instrs(psu_cfgs), \
+            (aginstr.a_reset, aginstr.a_power_off, aginstr.a_power_reset_cycle)
+    return aginstr.connect_instrs(rm, psu_cfgs), tuple(awaitable(func) for func in (
+        aginstr.reset, aginstr.power_off, aginstr.power_reset_cycle))
+
+
+# Launch OCD, UART, and GDB handler tasks for all chips as requested
+def launch_tasks(args: argparse.Namespace, psu_instrs: dict, psu_cfgs: dict) -> dict:
+    tasks = {}
+    log_dir = pathlib.Path(args.logdir)
+    if args.action in ('reset', 'cycle', 'run'):
+        # Launch OCD as needed
+        for keys, ocd in zip(args.chip_keys, args.ocds):
+            if ocd is not None:
+                ocd_path = log_dir / f'{keys.ocd}.log'
+                tasks[keys.ocd] = asyncio.create_task(dut.handle_ocd(
+                    end_event, args.ocdbin, ocd, ocd_path))
+    if args.action == 'run':
+        chips = zip(args.chip_keys, args.gdbs, args.uarts, args.bauds)
+        for d, (keys, gdb, uart, baud) in enumerate(chips):
+            # Launch UART as needed
+            if uart is not None:
+                meas_path = log_dir / f'measure{d}.json'
+                out_path = log_dir / f'{keys.uart}.log'
+                tasks[keys.uart] = asyncio.create_task(dut.handle_uart(
+                   end_event, uart, meas_path, out_path, psu_instrs,
+                   psu_cfgs, baud, TOOL_NAME))
+            # Launch GDB as needed
+            if gdb is not None:
+                gdb_path = log_dir / f'{keys.gdb}.log'
+                tasks[keys.gdb] = asyncio.create_task(dut.handle_gdb(
+                    end_event, args.gdbbin, gdb, gdb_path))
+    return tasks
+
+
 async def main(args: list) -> int:
     # Parse and validate args
     args = parse_and_validate_args(args)
+    dut.PPRINT_MEAS = args.verbose
 
     # Load PSU configs and connect to them
     instr_cfg = aginstr.config_from_yml(args.instr)
     rm = vs.ResourceManager()
-    psu_instrs = aginstr.connect_instrs(rm, instr_cfg['supplies'])
+    psu_instrs, (psu_reset, psu_power_off, psu_power_reset_cycle) = \
+        await connect_psus(rm, instr_cfg['supplies'], args.sockets)
     siggen_instrs = aginstr.connect_instrs(rm, instr_cfg['siggens'])
     psu_cfgs = instr_cfg['supplies']
     psus_ganged = instr_cfg['supplies']
@@ -198,64 +294,45 @@ async def main(args: list) -> int:
 
     # Handle supply management
     if args.action == 'reset':
-        aginstr.reconf_siggens(siggen_instrs, siggen_cfgs)
-        aginstr.reset(psu_instrs, psu_cfgs, args.trst)
+        await per_instr(aginstr.reconf_siggens, siggen_instrs, siggen_cfgs)
+        await psu_reset(psu_instrs, psu_cfgs, args.trst)
     elif args.action == 'poweroff':
-        aginstr.siggens_off(siggen_instrs, siggen_cfgs)
-        aginstr.power_off(psu_instrs, psu_cfgs, psus_ganged)
+        await per_instr(aginstr.siggens_off, siggen_instrs, siggen_cfgs)
+        await psu_power_off(psu_instrs, psu_cfgs, psus_ganged)
     elif args.action in ('cycle', 'run', 'leak'):
         if not args.noreconf:
-            aginstr.siggens_off(siggen_instrs, siggen_cfgs)
-            aginstr.power_reset_cycle(psu_instrs, psu_cfgs, psus_ganged, args.trst)
-            time.sleep(args.tswait)
+            await per_instr(aginstr.siggens_off, siggen_instrs, siggen_cfgs)
+            await psu_power_reset_cycle(psu_instrs, psu_cfgs, psus_ganged, args.trst)
+            await asyncio.sleep(args.tswait)
             await dut.async_meas(psu_instrs, psu_cfgs, name='_standby')
-            aginstr.reconf_siggens(siggen_instrs, siggen_cfgs)
+            await per_instr(aginstr.reconf_siggens, siggen_instrs, siggen_cfgs)
         if not args.noreset:
-            aginstr.reset(psu_instrs, psu_cfgs, args.trst)
+            await psu_reset(psu_instrs, psu_cfgs, args.trst)
     elif args.action == 'measure':
         await dut.async_meas(psu_instrs, psu_cfgs)
     else:
         raise ValueError(f'Unexpected action: {args.action}')
 
     if not args.action == 'measure':
-        time.sleep(args.trafter)
+        await asyncio.sleep(args.trafter)
         print('INFO: instrument control complete')
 
     if args.action == 'leak':
         print('INFO: Disabling chosen siggens for leakage measurement')
-        aginstr.siggens_off(siggen_instrs, siggen_cfgs)
-        time.sleep(args.tlwait)
+        await per_instr(aginstr.siggens_off, siggen_instrs, siggen_cfgs)
+        await asyncio.sleep(args.tlwait)
         await dut.async_meas(psu_instrs, psu_cfgs, name='_leak')
 
     # Handle asynchronous tasks
-    loop = asyncio.get_event_loop()
-    tasks = {}
-    log_dir = pathlib.Path(args.logdir)
-    if args.action in ('reset', 'cycle', 'run'):
-        # Launch OCD as needed
-        for d in range(args.nchips):
-            if vars(args)[f'ocd{d}'] is not None:
-                ocd_path = log_dir / f'ocd{d}.log'
-                tasks[f'ocd{d}'] = loop.create_task(dut.handle_ocd(
-                    end_event, args.ocdbin, vars(args)[f'ocd{d}'], ocd_path, args.tpoll))
-    if args.action == 'run':
-        for d in range(args.nchips):
-            # Launch UART as needed
-            if vars(args)[f'uart{d}'] is not None:
-                meas_path = log_dir / f'measure{d}.json'
-                out_path = log_dir / f'uart{d}.log'
-                tasks[f'uart{d}'] = loop.create_task(dut.handle_uart(
-                   end_event, vars(args)[f'uart{d}'], meas_path, out_path, psu_instrs,
-                   psu_cfgs, vars(args)[f'baud{d}'], args.tpoll, TOOL_NAME))
-            # Launch GDB as needed
-            if vars(args)[f'gdb{d}'] is not None:
-                gdb_path = log_dir / f'gdb{d}.log'
-                tasks[f'gdb{d}'] = loop.create_task(dut.handle_gdb(
-                    end_event, args.gdbbin, vars(args)[f'gdb{d}'], gdb_path, args.tpoll))
+    tasks = launch_tasks(args, psu_instrs, psu_cfgs)
 
     # Collect asynchronous tasks, OR returns
     results = (await asyncio.gather(*tasks.values())) if len(tasks) else []
     res_dict = dict(zip(tasks.keys(), results))
     if len(res_dict):
         print(f'INFO: subprocess return codes: {res_dict}')
-    return functools.reduce(lambda a, b: a or b, results, 0)
+
+    # Close socket connections to supplies
+    if args.sockets:
+        await asyncio.gather(*(instr.close() for instr in psu_instrs.values()))
+    return next((res for res in results if res), 0)
@@ -23,59 +23,83 @@
 
 import os
 import sys
-import glob
 import json
-from collections import defaultdict
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+import orjson
 
 
-# DUTCTL avoids name clashes by using a list of dicts.
+# DUTCTL avoids name clashes by writing one JSON object per line.
 # In our case, we know these have single keys and unique names,
-# so we can parse them into a simpler dict.
-def dutctl_list_to_dict(lst: list):
+# so we can parse them into a simpler dict. We load with `json`, as orjson
+# would turn integers beyond 64 bits (e.g. wide checksums) into floats.
+def dutctl_lines_to_dict(lines) -> dict:
     ret = {}
-    for item in lst:
-        for key, val in item.items():
+    for line in lines:
+        if not line.strip():
+            continue
+        for key, val in json.loads(line).items():
             ret[key] = val
     return ret
 
 
+# Parse and check one run, returning its parameter levels and data, or None if the run
+# could not be parsed. Golden (key, value) items of None skip correctness checks.
+def parse_one(path: str, gold_items: list = None) -> (list, dict):
+    # Check basic correctness: file is JSON.
+    with open(path, 'rb') as file:
+        try:
+            run_data = dutctl_lines_to_dict(file)
+        except json.JSONDecodeError:
+            return None
+    # Check logical correctness in one pass: all golden keys present and matching.
+    if gold_items is not None:
+        run_data['correct'] = all(k in run_data and run_data[k] == v for k, v in gold_items)
+    run_name = os.path.basename(os.path.dirname(path))
+    return run_name.split('^'), run_data
+
+
+# Collect measurement files of runs, which are direct (non-hidden) subdirectories
+def run_paths(runs_dir: str) -> list:
+    paths = []
+    with os.scandir(runs_dir) as entries:
+        for entry in entries:
+            if entry.is_dir() and not entry.name.startswith('.'):
+                path = os.path.join(entry.path, 'measure0.json')
+                if os.path.isfile(path):
+                    paths.append(path)
+    return paths
+
+
 def main(runs_dir: str, gold_path: str = None) -> int:
     # If provided, open golden result file first
-    gold = {}
+    gold_items = None
     if gold_path is not None:
-        with open(gold_path, 'r', encoding='utf-8') as file:
-            gold = json.load(file)
-
-    # Defaultdicts self-populate on keying, which simplifies things
-    dd_tree = lambda : defaultdict(dd_tree)  # pylint: disable=unnecessary-lambda-assignment
-    runs = dd_tree()
-
-    # Iterate over available runs, check correctness, and add to dict
-    for path in glob.glob(f'{runs_dir}/**/measure0.json'):
-
-        # Check basic correctness: file is JSON and has all needed keys.
-        with open(path, 'r', encoding='utf-8') as file:
-            try:
-                run_data = dutctl_list_to_dict(json.load(file))
-                if gold_path is not None:
-                    run_data['correct'] = all(k in run_data for k in gold)
-            except json.decoder.JSONDecodeError:
-                if gold_path is not None:
-                    run_data = {'correct': False}
+        with open(gold_path, 'rb') as file:
+            gold_items = list(json.loads(file.read()).items())
+
+    runs = {}
+
+    # Parse and check available runs in parallel, then add them to dict
+    paths = run_paths(runs_dir)
+    with ProcessPoolExecutor() as executor:
+        for parsed in executor.map(partial(parse_one, gold_items=gold_items), paths, chunksize=64):
+            if parsed is None:
                 continue
-        # Check logical correctness: measurements should match golden ones.
-        if gold_path is not None and run_data['correct']:
-            run_data['correct'] = all(run_data[k] == gold[k] for k in gold)
-        # Write data to run dict using recursive indexing
-        curr_dict = runs
-        run_name = os.path.basename(os.path.dirname(path))
-        levels = run_name.split('^')
-        for g in levels[:-1]:
-            curr_dict = curr_dict[g]
-        curr_dict[levels[-1]] = run_data
+            # Write data to run dict, creating intermediate levels as needed
+            levels, run_data = parsed
+            curr_dict = runs
+            for g in levels[:-1]:
+                curr_dict = curr_dict.setdefault(g, {})
+            curr_dict[levels[-1]] = run_data
 
     # Write out results as JSON (pipe to file if needed)
-    print(json.dumps(runs, indent=2))
+    try:
+        report = orjson.dumps(runs, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE)
+    except orjson.JSONEncodeError:
+        # orjson rejects integers beyond 64 bits; fall back to the same format with `json`
+        report = (json.dumps(runs, indent=2, ensure_ascii=False) + '\n').encode()
+    sys.stdout.buffer.write(report)
 
     return 0
 
@@ -28,14 +28,11 @@
 # provided cycle count.
 
 import sys
-import json
-from collections import defaultdict
-import numpy as np
-import matplotlib as mpl
-import matplotlib.pyplot as plt
+import orjson
 
-# We don't need an interactive backend for matplotlib
-mpl.use('Agg')
+
+# Indices of the data grids in the buffer built by `generate_data`
+CORR, P, E, EFF = range(4)
 
 
 # pylint: disable=too-many-locals
@@ -43,55 +40,62 @@ def generate_data(
         runs_path: str,
         pmeas: str = None, psupply: str = None, pchan: str = None,
         cmeas: str = None, citer: str = '1', ops : str = None) -> dict:
+    # Heavy imports are deferred to keep startup fast
+    import numpy as np  # pylint: disable=import-outside-toplevel
+
     # Read runs file
-    with open(runs_path, 'r', encoding='utf-8') as file:
-        runs = json.load(file)
-
-    # Extract 1D axes: cast & sort voltages, then extract freq steps from lowest one
-    vs_mv = sorted([int(vstr) for vstr in runs.keys()])
-    fs_mhz = sorted([int(fstr) for fstr in runs[str(vs_mv[0])].keys()])
-
-    # Extract 2D data from runs
-    ret = defaultdict(list)
-    for v_mv in vs_mv:
-        row_corrects = []
-        row_ps_mw = []
-        row_es_mj = []
-        row_effs_mflop_per_s_per_w = []
-        for f_mhz in fs_mhz:
-            # Defaults: incorrect, NaNs (unplotted) for numbers
-            correct = np.nan
-            p_mw = np.nan
-            e_mj = np.nan
-            eff_mflop_per_s_per_w = np.nan
-            if str(f_mhz) in runs[str(v_mv)]:
-                run = runs[str(v_mv)][str(f_mhz)]
-                if run['correct']:
-                    correct = 1
-                    if pmeas is not None:
-                        current_a = float(run[pmeas][psupply][pchan]['cur'])
-                        p_mw = float(v_mv) * current_a
-                    if cmeas is not None:
-                        tmeas_s = float(run[cmeas]) / float(citer) * 1e-6 / float(f_mhz)
-                        e_mj = p_mw * tmeas_s
-                    if ops is not None:
-                        eff_mflop_per_s_per_w = float(ops) * 1e-3 / e_mj
-            row_corrects.append(correct)
-            row_ps_mw.append(p_mw)
-            row_es_mj.append(e_mj)
-            row_effs_mflop_per_s_per_w.append(eff_mflop_per_s_per_w)
-        ret['corrects'].append(row_corrects)
-        ret['ps_mw'].append(row_ps_mw)
-        ret['es_mj'].append(row_es_mj)
-        ret['effs_mflop_per_s_per_w'].append(row_effs_mflop_per_s_per_w)
+    with open(runs_path, 'rb') as file:
+        runs = orjson.loads(file.read())
+
+    # Extract 1D axes: sort voltage keys numerically, then extract freq steps from lowest one.
+    # The keys are kept to index runs without converting back to strings.
+    v_keys = sorted(runs.keys(), key=int)
+    f_keys = sorted(runs[v_keys[0]].keys(), key=int)
+    vs_mv = [int(vstr) for vstr in v_keys]
+    fs_mhz = [int(fstr) for fstr in f_keys]
+
+    # Gather per-run values into one preallocated buffer of grids; NaNs (unplotted) where
+    # incorrect or missing. Power and energy grids first hold currents and cycles, respectively.
+    out = np.full((4, len(vs_mv), len(fs_mhz)), np.nan)
+    f_to_j = {fstr: j for j, fstr in enumerate(f_keys)}
+    for i, vstr in enumerate(v_keys):
+        for fstr, run in runs[vstr].items():
+            j = f_to_j.get(fstr)
+            if j is None or not run['correct']:
+                continue
+            out[CORR, i, j] = 1
+            if pmeas is not None:
+                out[P, i, j] = float(run[pmeas][psupply][pchan]['cur'])
+            if cmeas is not None:
+                out[E, i, j] = float(run[cmeas])
+
+    # Derive power, energy, and efficiency in place on whole grids
+    out[P] *= np.array(vs_mv, dtype=float)[:, None]
+    out[E] /= float(citer)
+    out[E] *= 1e-6
+    out[E] /= np.array(fs_mhz, dtype=float)[None, :]
+    out[E] *= out[P]
+    if ops is not None:
+        np.divide(float(ops) * 1e-3, out[E], out=out[EFF])
 
     # Add voltage (in volts) and frequency and return data
-    ret['vs_v'] = 1e-3 * np.array(vs_mv)
-    ret['fs_mhz'] = fs_mhz
-    return dict(ret)
+    return {
+        'corrects': out[CORR],
+        'ps_mw': out[P],
+        'es_mj': out[E],
+        'effs_mflop_per_s_per_w': out[EFF],
+        'vs_v': 1e-3 * np.array(vs_mv),
+        'fs_mhz': np.array(fs_mhz)
+    }
 
 
 def main(out_file: str, *genargs) -> int:
+    # We don't need an interactive backend for matplotlib
+    # pylint: disable=import-outside-toplevel
+    import matplotlib as mpl
+    mpl.use('Agg')
+    import matplotlib.pyplot as plt
+
     # Generate data to be plotted
     data = generate_data(*genargs)
 